@@ -0,0 +1,306 @@
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from geometry import simplify
+
+# Contour lines generated from the DEM per Web Mercator tile (z/x/y, same scheme as the
+# base layers). build_tile() samples an elevation grid, runs marching squares for every
+# contour level of the zoom's interval and simplifies the lines; the terrain service runs
+# it (the "contours" op) so the GUI process only schedules tiles. ContourService keeps the
+# viewport's tiles queued in a small worker pool and caches the results; tiles that leave
+# the viewport before they are done are cancelled and never sent to the page.
+
+try:
+    import numpy as np  # type: ignore
+    _contours_available = True
+except Exception as _contours_err:
+    print(f"[Contours] numpy not available: {_contours_err}")
+    _contours_available = False
+
+MIN_CONTOUR_ZOOM = 10       # below this tiles are too large for useful DEM contours
+MAX_CONTOUR_ZOOM = 17
+GRID_SIZE = 129             # samples per tile edge (128 cells)
+CACHE_TILES = 512
+WORKERS = 2
+MAJOR_EVERY = 5             # every 5th contour is an index contour
+RETRY_TILE_S = 1.0          # tile_fn had no answer yet (service still starting): try again after this
+
+# zoom -> contour interval in metres
+CONTOUR_INTERVALS = {10: 100, 11: 50, 12: 25, 13: 20, 14: 10, 15: 5, 16: 5, 17: 2}
+
+
+def contour_interval(zoom):
+    zoom = max(MIN_CONTOUR_ZOOM, min(MAX_CONTOUR_ZOOM, int(zoom)))
+    return CONTOUR_INTERVALS[zoom]
+
+
+def tile_bounds(z, x, y):
+    """(west, south, east, north) of tile z/x/y."""
+    n = 2 ** z
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+
+def tiles_for_bounds(z, west, south, east, north):
+    """Tiles (x, y) at zoom z covering the lat/lng bounds."""
+    n = 2 ** z
+
+    def tx(lng):
+        return min(n - 1, max(0, int((lng + 180.0) / 360.0 * n)))
+
+    def ty(lat):
+        lat = max(-85.05112878, min(85.05112878, lat))
+        r = math.radians(lat)
+        return min(n - 1, max(0, int((1 - math.log(math.tan(r) + 1 / math.cos(r)) / math.pi) / 2 * n)))
+    return [(x, y) for y in range(ty(north), ty(south) + 1) for x in range(tx(west), tx(east) + 1)]
+
+
+# (corner case) -> crossed cell edges joined by a segment; 0 top, 1 right, 2 bottom, 3 left.
+# Saddles 5 and 10 are resolved with the cell centre value in marching_squares().
+_SEGMENTS = {
+    1: ((3, 2),), 2: ((2, 1),), 3: ((3, 1),), 4: ((0, 1),), 6: ((0, 2),), 7: ((3, 0),),
+    8: ((3, 0),), 9: ((0, 2),), 11: ((0, 1),), 12: ((3, 1),), 13: ((2, 1),), 14: ((3, 2),),
+}
+_SADDLE_SEGMENTS = {
+    # (case, centre above level) -> segments
+    (5, True): ((3, 0), (2, 1)), (5, False): ((0, 1), (3, 2)),
+    (10, True): ((0, 1), (3, 2)), (10, False): ((3, 0), (2, 1)),
+}
+
+
+def marching_squares(grid, level):
+    """Contour lines of `grid` at `level` as lists of (row, col) float points.
+
+    Cells touching NaN are skipped. Segments are joined through the grid edge they
+    cross, so lines come out as continuous (open or closed) polylines.
+    """
+    h, w = grid.shape
+    tl, tr = grid[:-1, :-1], grid[:-1, 1:]
+    bl, br = grid[1:, :-1], grid[1:, 1:]
+    valid = ~(np.isnan(tl) | np.isnan(tr) | np.isnan(bl) | np.isnan(br))
+    with np.errstate(invalid="ignore"):
+        case = ((tl >= level) * 8 + (tr >= level) * 4 + (br >= level) * 2 + (bl >= level)).astype(np.int8)
+    case[~valid] = 0
+    case[case == 15] = 0
+
+    # edge ids: horizontal edge (r, c) between grid[r, c] and grid[r, c+1] -> 2*(r*w+c),
+    # vertical edge (r, c) between grid[r, c] and grid[r+1, c] -> 2*(r*w+c)+1
+    def edge_ids(rows, cols, side):
+        if side == 0:
+            return 2 * (rows * w + cols)
+        if side == 2:
+            return 2 * ((rows + 1) * w + cols)
+        if side == 3:
+            return 2 * (rows * w + cols) + 1
+        return 2 * (rows * w + cols + 1) + 1
+
+    a_ids, b_ids = [], []
+    for k in np.unique(case):
+        if k == 0:
+            continue
+        rows, cols = np.nonzero(case == k)
+        if k in (5, 10):
+            centre = (tl[rows, cols] + tr[rows, cols] + bl[rows, cols] + br[rows, cols]) / 4 >= level
+            for above in (True, False):
+                sel = centre == above
+                for e1, e2 in _SADDLE_SEGMENTS[(int(k), above)]:
+                    a_ids.append(edge_ids(rows[sel], cols[sel], e1))
+                    b_ids.append(edge_ids(rows[sel], cols[sel], e2))
+        else:
+            for e1, e2 in _SEGMENTS[int(k)]:
+                a_ids.append(edge_ids(rows, cols, e1))
+                b_ids.append(edge_ids(rows, cols, e2))
+    if not a_ids:
+        return []
+    a_ids = np.concatenate(a_ids)
+    b_ids = np.concatenate(b_ids)
+
+    # crossing point on every used edge
+    ids = np.unique(np.concatenate([a_ids, b_ids]))
+    cell = ids // 2
+    r, c = cell // w, cell % w
+    vertical = (ids % 2) == 1
+    r2 = np.where(vertical, r + 1, r)
+    c2 = np.where(vertical, c, c + 1)
+    z1, z2 = grid[r, c], grid[r2, c2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.clip(np.nan_to_num((level - z1) / (z2 - z1), nan=0.5), 0.0, 1.0)
+    point_of = dict(zip(ids.tolist(), zip((r + (r2 - r) * t).tolist(), (c + (c2 - c) * t).tolist())))
+
+    # join segments: every edge is shared by at most two segments
+    neighbours = {}
+    for a, b in zip(a_ids.tolist(), b_ids.tolist()):
+        neighbours.setdefault(a, []).append(b)
+        neighbours.setdefault(b, []).append(a)
+
+    lines = []
+    seen = set()
+
+    def walk(start):
+        line = [start]
+        seen.add(start)
+        prev, cur = None, start
+        while True:
+            nxt = [n for n in neighbours[cur] if n != prev and n not in seen]
+            if not nxt:
+                if len(line) > 2 and start in neighbours[cur] and prev is not None:
+                    line.append(start)   # closed ring
+                break
+            prev, cur = cur, nxt[0]
+            seen.add(cur)
+            line.append(cur)
+        return [point_of[e] for e in line]
+
+    # open lines start at an end (edge used once), then the remaining rings
+    for e, nb in neighbours.items():
+        if len(nb) == 1 and e not in seen:
+            lines.append(walk(e))
+    for e in neighbours:
+        if e not in seen:
+            lines.append(walk(e))
+
+    # a level equal to sample values puts crossings on grid points, where several edges
+    # meet: drop repeated points and the lines that collapse to a single point
+    out = []
+    for ln in lines:
+        pts = [ln[0]] + [p for p, q in zip(ln[1:], ln) if p != q]
+        if len(set(pts)) >= 2:
+            out.append(pts)
+    return out
+
+
+def contour_tile(grid, bounds, interval, tolerance=0.35):
+    """Contour lines of a tile grid as [{"elev", "major", "coords": [[lat, lng], ...]}]."""
+    if grid is None or np.all(np.isnan(grid)):
+        return []
+    west, south, east, north = bounds
+    h, w = grid.shape
+    lo, hi = np.nanmin(grid), np.nanmax(grid)
+    first = math.ceil(lo / interval) * interval
+
+    # grid rows are regular in Web Mercator y (see terrain_service.grid_lonlats)
+    def merc_y(lat):
+        s = math.sin(math.radians(lat))
+        return 0.5 * math.log((1 + s) / (1 - s))
+    y_top, y_bottom = merc_y(north), merc_y(south)
+
+    out = []
+    level = first
+    while level <= hi:
+        for line in marching_squares(grid, level):
+            line = simplify(line, tolerance)
+            coords = []
+            for r, c in line:
+                y = y_top + (y_bottom - y_top) * r / (h - 1)
+                lat = math.degrees(2 * math.atan(math.exp(y)) - math.pi / 2)
+                lng = west + (east - west) * c / (w - 1)
+                coords.append([round(lat, 6), round(lng, 6)])
+            out.append({"elev": level, "major": (level // interval) % MAJOR_EVERY == 0, "coords": coords})
+        level += interval
+    return out
+
+
+def build_tile(grid_fn, z, x, y, grid_size=GRID_SIZE):
+    """Contour tile z/x/y as {"key", "interval", "lines"}.
+
+    `grid_fn(west, south, east, north, width, height)` returns the tile's elevation
+    grid (NaN = no data) or None.
+    """
+    bounds = tile_bounds(z, x, y)
+    grid = grid_fn(*bounds, grid_size, grid_size)
+    interval = contour_interval(z)
+    return {"key": "%d/%d/%d" % (z, x, y), "interval": interval, "lines": contour_tile(grid, bounds, interval)}
+
+
+class ContourService:
+    """Schedules contour tiles for the current viewport in a worker pool.
+
+    `tile_fn(z, x, y)` returns the built tile (see build_tile), {"error": ...}, or None
+    when it cannot build tiles right now (the tile is then requeued after RETRY_TILE_S);
+    `emit_fn(key, tile)` receives each finished tile.
+    """
+
+    def __init__(self, tile_fn, emit_fn, workers=WORKERS, cache_tiles=CACHE_TILES):
+        self.tile_fn = tile_fn
+        self.emit_fn = emit_fn
+        self.cache_tiles = cache_tiles
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="contours")
+        self.cache = OrderedDict()   # "z/x/y" -> tile dict
+        self.pending = {}            # "z/x/y" -> Future
+        self.wanted = set()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def update_viewport(self, zoom, west, south, east, north):
+        """Schedule tiles for the viewport, cancel the rest; returns the wanted tile keys."""
+        z = int(math.floor(zoom))
+        if self.closed or not _contours_available or z < MIN_CONTOUR_ZOOM:
+            self.cancel_all()
+            return []
+        z = min(z, MAX_CONTOUR_ZOOM)
+        keys = ["%d/%d/%d" % (z, x, y) for x, y in tiles_for_bounds(z, west, south, east, north)]
+        ready = []
+        with self.lock:
+            self.wanted = set(keys)
+            for key, fut in list(self.pending.items()):
+                if key not in self.wanted:
+                    fut.cancel()  # running tiles notice self.wanted and drop their result
+                    del self.pending[key]
+            for key in keys:
+                tile = self.cache.get(key)
+                if tile is not None:
+                    self.cache.move_to_end(key)
+                    ready.append(tile)
+                elif key not in self.pending:
+                    self.pending[key] = self.pool.submit(self._build, key)
+        for tile in ready:
+            self.emit_fn(tile["key"], tile)
+        return keys
+
+    def cancel_all(self):
+        with self.lock:
+            self.wanted = set()
+            for fut in self.pending.values():
+                fut.cancel()
+            self.pending = {}
+
+    def _build(self, key):
+        try:
+            if key not in self.wanted:
+                return
+            z, x, y = (int(v) for v in key.split("/"))
+            tile = self.tile_fn(z, x, y)
+            if tile is None:
+                timer = threading.Timer(RETRY_TILE_S, self._requeue, (key,))
+                timer.daemon = True
+                timer.start()
+                return
+            if "error" in tile:
+                raise RuntimeError(tile["error"])
+            with self.lock:
+                self.cache[key] = tile
+                while len(self.cache) > self.cache_tiles:
+                    self.cache.popitem(last=False)
+                self.pending.pop(key, None)
+                wanted = key in self.wanted
+            if wanted and not self.closed:
+                self.emit_fn(key, tile)
+        except Exception as e:
+            print(f"[Contours] tile {key} failed: {e}")
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def _requeue(self, key):
+        with self.lock:
+            if not self.closed and key in self.wanted and key in self.pending:
+                self.pending[key] = self.pool.submit(self._build, key)
+
+    def shutdown(self):
+        """Cancel queued tiles and stop emitting; a tile being built is dropped when done."""
+        self.closed = True
+        self.cancel_all()
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,44 @@
+import math
+
+# Small 2-D polyline helpers shared by the contour overlay and terrain routing.
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a list of 2-D points."""
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        (x1, y1), (x2, y2) = points[i], points[j]
+        dx, dy = x2 - x1, y2 - y1
+        norm = math.hypot(dx, dy)
+        best, best_d = None, tolerance
+        for k in range(i + 1, j):
+            px, py = points[k]
+            if norm > 0:
+                d = abs(dy * (px - x1) - dx * (py - y1)) / norm
+            else:
+                d = math.hypot(px - x1, py - y1)
+            if d > best_d:
+                best, best_d = k, d
+        if best is not None:
+            keep[best] = True
+            stack.append((i, best))
+            stack.append((best, j))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def merge_collinear(points):
+    """Drop points in the middle of straight runs; the line still passes through every point."""
+    if len(points) < 3:
+        return list(points)
+    out = [points[0]]
+    for (x0, y0), (x1, y1), (x2, y2) in zip(points, points[1:], points[2:]):
+        ax, ay, bx, by = x1 - x0, y1 - y0, x2 - x1, y2 - y1
+        if ax * by - ay * bx != 0 or ax * bx + ay * by <= 0:
+            out.append((x1, y1))
+    out.append(points[-1])
+    return out
@@ -5,9 +5,14 @@ import os
 import platform
 import time
 from style import style
+from marker_cluster import MarkerClusterIndex
+from terrain_service import TerrainClient, SERVICE_FLAG, serve as serve_terrain, grid_lonlats, read_points
+from contours import ContourService, build_tile as build_contour_tile
+from routing import find_route
 import json 
 from tkinter import filedialog, colorchooser
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Windows-specific imports
 if platform.system() == "Windows":
@@ -28,6 +33,13 @@ except Exception as _elev_err:
     print(f"[Elevation] rasterio/pyproj not available: {_elev_err}")
     _elev_available = False
 
+# Shared terrain service (one per user); sample_elevations falls back to the DEM below
+_terrain_client = TerrainClient(DEM_PATH)
+_elev_lock = threading.Lock()  # in-process DEM is read from the CEF thread and contour workers
+_route_client = TerrainClient(DEM_PATH)  # own connection so a long search doesn't hold up sampling
+_contour_client = TerrainClient(DEM_PATH)
+_grid_client = TerrainClient(DEM_PATH)  # worker-thread grid reads; large replies never hold up _terrain_client
+
 def _elev_ensure_open():
     global _elev_ds, _elev_transformer, _elev_available
     if not _elev_available:
@@ -44,7 +56,7 @@ def _elev_ensure_open():
     return True
 
 def sample_elevations(points_json: str) -> str:
-    """Return elevations for given JSON points list [{lat,lng},...] using local DEM."""
+    """Return elevations for given JSON points list [{lat,lng},...] from the terrain service or local DEM."""
     try:
         pts = json.loads(points_json)
         if not isinstance(pts, list):
@@ -52,14 +64,19 @@ def sample_elevations(points_json: str) -> str:
     except Exception as e:
         return json.dumps({"elevations": [], "error": f"bad_input: {e}"})
 
+    lons = [p.get("lng") for p in pts]
+    lats = [p.get("lat") for p in pts]
+    remote = _terrain_client.sample(lons, lats)
+    if remote is not None:
+        return json.dumps({"elevations": remote})
+
     if not _elev_ensure_open():
         return json.dumps({"elevations": [None]*len(pts), "error": "dem_unavailable"})
 
-    lons = [p.get("lng") for p in pts]
-    lats = [p.get("lat") for p in pts]
     try:
         xs, ys = _elev_transformer.transform(lons, lats)
-        vals = list(_elev_ds.sample(zip(xs, ys)))  # nearest neighbour
+        with _elev_lock:
+            vals = list(_elev_ds.sample(zip(xs, ys)))  # nearest neighbour
     except Exception as e:
         return json.dumps({"elevations": [None]*len(pts), "error": f"sample_failed: {e}"})
 
@@ -76,8 +93,40 @@ def sample_elevations(points_json: str) -> str:
         out.append(z)
     return json.dumps({"elevations": out})
 
+def sample_grid(west, south, east, north, width, height):
+    """Elevation grid over lon/lat bounds (NaN = no data) from the terrain service or local DEM."""
+    grid = _grid_client.grid(west, south, east, north, width, height)
+    if grid is not None:
+        return grid
+    if not _elev_ensure_open():
+        return None
+    lons, lats = grid_lonlats(west, south, east, north, width, height)
+    with _elev_lock:
+        return read_points(_elev_ds, _elev_transformer, lons, lats)
+
+def contour_tile_at(z, x, y):
+    """Contour tile z/x/y from the terrain service; built in-process only when the service is unavailable.
+
+    None while the service is still starting (ContourService tries again shortly).
+    """
+    tile = _contour_client.contours(z, x, y)
+    if tile is None and _contour_client.unavailable():
+        tile = build_contour_tile(sample_grid, z, x, y)
+    return tile
+
+def route_between(start, end, max_grade=None, cancelled=None):
+    """Least-cost terrain route between (lat, lng) points, in the terrain service if reachable.
+
+    `cancelled()` stops an in-process search early; a search in the service runs to the end.
+    """
+    result = _route_client.route(start, end, max_grade)
+    if result is None:
+        result = find_route(sample_grid, start, end, max_grade=max_grade, cancelled=cancelled)
+    return result
+
 # Declare global browser
 browser = None
+js_bindings = None  # kept so on_closing can stop the contour workers
 
 def main():
     global browser
@@ -92,6 +141,10 @@ def main():
 
     cef.Initialize()
 
+    # Reach (or start) the terrain service in the background so the first profile is fast
+    _terrain_client.connect_async()
+    _contour_client.connect_async()
+
     def get_map_frame_dimensions():
         width = map_frame.winfo_width()
         height = map_frame.winfo_height()
@@ -112,7 +165,7 @@ def main():
 
     def create_browser():
         """Create CEF browser as a child window, bind JS first, then load the map."""
-        global browser
+        global browser, js_bindings
         map_frame.update()
         width, height = get_map_frame_dimensions()
         if width > 0 and height > 0:
@@ -127,7 +180,8 @@ def main():
 
             # Bindings BEFORE loading the real page
             bindings = cef.JavascriptBindings(bindToFrames=False, bindToPopups=False)
-            bindings.SetObject("cefPythonBindings", JSBindings(browser_local, root))
+            js_bindings = JSBindings(browser_local, root)
+            bindings.SetObject("cefPythonBindings", js_bindings)
             browser_local.SetJavascriptBindings(bindings)
 
             # Now load the actual map html
@@ -142,6 +196,11 @@ def main():
         def __init__(self, browser_instance, tk_root):
             self.browser = browser_instance
             self.tk_root = tk_root
+            self.marker_index = MarkerClusterIndex()
+            self.contours = ContourService(contour_tile_at, self._post_contour_tile)
+            self.route_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="route")
+            self.route_future = None
+            self.route_seq = 0   # only the newest findTerrainRoute request is searched/answered
             
         def saveShapesToFile(self, json_str, file_path):
             print("saveShapesToFile called!")
@@ -182,11 +241,111 @@ def main():
             except Exception as e:
                 print(f"Failed to schedule color picker: {e}")
 
-        def getElevations(self, points_json):
+        def getElevations(self, points_json, js_callback):
+            """Elevations for [{lat,lng},...]; sampled off the UI thread, answered through js_callback."""
+            def run():
+                try:
+                    payload = sample_elevations(points_json)
+                except Exception as e:
+                    payload = json.dumps({"elevations": [], "error": f"exception: {e}"})
+                try:
+                    cef.PostTask(cef.TID_UI, lambda: js_callback.Call(payload))
+                except Exception as e:
+                    print(f"JS callback getElevations failed: {e}")
+            threading.Thread(target=run, daemon=True).start()
+
+        # Marker clustering: the page keeps only visible/singleton markers as real L.markers
+        def loadClusterMarkers(self, markers_json):
+            try:
+                added = self.marker_index.add_many(json.loads(markers_json))
+                return json.dumps({"added": added, "count": len(self.marker_index.points)})
+            except Exception as e:
+                return json.dumps({"added": 0, "error": f"exception: {e}"})
+
+        def moveClusterMarker(self, marker_id, lat, lng):
+            return json.dumps({"ok": self.marker_index.move(marker_id, lat, lng)})
+
+        def removeClusterMarker(self, marker_id):
+            return json.dumps({"ok": self.marker_index.remove(marker_id)})
+
+        def clearClusterMarkers(self):
+            self.marker_index.clear()
+            return json.dumps({"ok": True})
+
+        # Terrain routing runs on one worker thread; the result is pushed to showTerrainRoute().
+        # A new request cancels the queued one and stops a running in-process search.
+        def findTerrainRoute(self, request_json):
+            try:
+                req = json.loads(request_json)
+                start = (float(req["start"]["lat"]), float(req["start"]["lng"]))
+                end = (float(req["end"]["lat"]), float(req["end"]["lng"]))
+                max_grade = req.get("max_grade")
+            except Exception as e:
+                return json.dumps({"started": False, "error": f"bad_input: {e}"})
+
+            self.route_seq += 1
+            seq = self.route_seq
+
+            def stale():
+                return seq != self.route_seq
+
+            def run():
+                if stale():
+                    return
+                try:
+                    result = route_between(start, end, max_grade, cancelled=stale)
+                except Exception as e:
+                    result = {"error": f"exception: {e}"}
+                if stale():
+                    return
+                result["request_id"] = req.get("request_id")
+                payload = json.dumps(result)
+                try:
+                    cef.PostTask(cef.TID_UI, lambda: (
+                        self.browser and self.browser.GetMainFrame().ExecuteFunction("showTerrainRoute", payload)
+                    ))
+                except Exception as e:
+                    print(f"JS call showTerrainRoute failed: {e}")
+            if self.route_future is not None:
+                self.route_future.cancel()
+            self.route_future = self.route_pool.submit(run)
+            return json.dumps({"started": True})
+
+        # Contour overlay: tiles are built in worker threads and pushed to the page
+        def requestContours(self, zoom, bounds_json):
+            try:
+                b = json.loads(bounds_json)
+                keys = self.contours.update_viewport(zoom, b["west"], b["south"], b["east"], b["north"])
+                return json.dumps({"tiles": keys})
+            except Exception as e:
+                return json.dumps({"tiles": [], "error": f"exception: {e}"})
+
+        def cancelContours(self):
+            self.contours.cancel_all()
+            return json.dumps({"ok": True})
+
+        def _post_contour_tile(self, key, tile):
+            if self.contours.closed:
+                return
+            payload = json.dumps(tile)
+            try:
+                cef.PostTask(cef.TID_UI, lambda: (
+                    self.browser and self.browser.GetMainFrame().ExecuteFunction("addContourTile", key, payload)
+                ))
+            except Exception as e:
+                print(f"JS call addContourTile failed: {e}")
+
+        def getMarkerClusters(self, request_json, js_callback):
+            """Clusters for {request_id, zoom, bounds}; the reply goes to js_callback."""
+            req = {}
             try:
-                return sample_elevations(points_json)
+                req = json.loads(request_json)
+                b = req["bounds"]
+                result = self.marker_index.get_clusters(req["zoom"], b["west"], b["south"], b["east"], b["north"])
             except Exception as e:
-                return json.dumps({"elevations": [], "error": f"exception: {e}"})
+                result = {"clusters": [], "points": [], "error": f"exception: {e}"}
+            result["request_id"] = req.get("request_id")
+            js_callback.Call(json.dumps(result))
 
     # JS bindings class defined; now create browser
     browser = create_browser()
@@ -331,6 +490,14 @@ def main():
 
     def on_closing():
         global browser
+        if js_bindings:
+            js_bindings.contours.shutdown()
+            js_bindings.route_seq += 1  # stops a running in-process route search
+            js_bindings.route_pool.shutdown(wait=False)
+        _terrain_client.close_connection()
+        _route_client.close_connection()
+        _contour_client.close_connection()
+        _grid_client.close_connection()
         if browser:
             browser.CloseBrowser(True)
             browser = None
@@ -351,4 +518,7 @@ def main():
     root.mainloop()
 
 if __name__ == '__main__':
-    main()
+    if SERVICE_FLAG in sys.argv:
+        serve_terrain()
+    else:
+        main()
@@ -0,0 +1,200 @@
+import math
+
+# Hierarchical grid clustering for large marker sets (Supercluster-style).
+# Points are projected to Web Mercator in [0, 1) and bucketed into square cells
+# of CLUSTER_RADIUS screen pixels for every zoom level. Because the cell size
+# halves from one zoom to the next, cells nest exactly: a cell at zoom z is the
+# union of four cells at zoom z + 1. That keeps add/move/remove O(zoom levels)
+# and lets the page ask for only what is visible at the current zoom.
+
+CLUSTER_RADIUS = 64   # cluster cell size in screen pixels
+TILE_SIZE = 256
+MIN_ZOOM = 0
+MAX_ZOOM = 16         # above this every marker is returned on its own
+
+
+def _project(lat, lng):
+    """Project lat/lng to Web Mercator coordinates in [0, 1)."""
+    lat = max(-85.05112878, min(85.05112878, float(lat)))
+    x = float(lng) / 360.0 + 0.5
+    s = math.sin(math.radians(lat))
+    y = 0.5 - 0.25 * math.log((1 + s) / (1 - s)) / math.pi
+    return min(max(x, 0.0), 1.0 - 1e-12), min(max(y, 0.0), 1.0 - 1e-12)
+
+
+def _unproject(x, y):
+    lng = (x - 0.5) * 360.0
+    lat = math.degrees(2 * math.atan(math.exp((0.5 - y) * 2 * math.pi)) - math.pi / 2)
+    return lat, lng
+
+
+class MarkerClusterIndex:
+    """Incrementally updated cluster index over marker points.
+
+    Every point lives in exactly one cell per zoom level; each cell keeps its
+    member ids and coordinate sums so its centroid can be updated without
+    rescanning.
+    """
+
+    def __init__(self, radius=CLUSTER_RADIUS, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+        self.radius = radius
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.points = {}   # id -> (lat, lng, x, y, props)
+        # per zoom: (cx, cy) -> [sum_x, sum_y, set of ids]
+        self.levels = {z: {} for z in range(min_zoom, max_zoom + 1)}
+
+    def _cells_per_unit(self, zoom):
+        return TILE_SIZE * (2 ** zoom) / float(self.radius)
+
+    def _cell(self, x, y, zoom):
+        n = self._cells_per_unit(zoom)
+        return int(x * n), int(y * n)
+
+    def _insert(self, pid, x, y):
+        for z, cells in self.levels.items():
+            key = self._cell(x, y, z)
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = [x, y, {pid}]
+            else:
+                cell[0] += x
+                cell[1] += y
+                cell[2].add(pid)
+
+    def _discard(self, pid, x, y):
+        for z, cells in self.levels.items():
+            key = self._cell(x, y, z)
+            cell = cells.get(key)
+            if cell is None:
+                continue
+            cell[2].discard(pid)
+            if not cell[2]:
+                del cells[key]
+            else:
+                cell[0] -= x
+                cell[1] -= y
+
+    # --- edits ---
+    def add_many(self, markers):
+        """Bulk insert markers [{id, lat, lng, ...}, ...]; returns how many were added."""
+        added = 0
+        for m in markers:
+            if self.add(m.get("id"), m.get("lat"), m.get("lng"), m):
+                added += 1
+        return added
+
+    def clear(self):
+        self.points = {}
+        self.levels = {z: {} for z in range(self.min_zoom, self.max_zoom + 1)}
+
+    def add(self, pid, lat, lng, props=None):
+        if pid is None or lat is None or lng is None:
+            return False
+        if pid in self.points:
+            self.remove(pid)
+        x, y = _project(lat, lng)
+        props = dict(props or {})
+        props.pop("lat", None)
+        props.pop("lng", None)
+        props["id"] = pid
+        self.points[pid] = (float(lat), float(lng), x, y, props)
+        self._insert(pid, x, y)
+        return True
+
+    def move(self, pid, lat, lng):
+        p = self.points.get(pid)
+        if p is None:
+            return False
+        return self.add(pid, lat, lng, p[4])
+
+    def remove(self, pid):
+        p = self.points.pop(pid, None)
+        if p is None:
+            return False
+        self._discard(pid, p[2], p[3])
+        return True
+
+    # --- queries ---
+    def _point_json(self, pid):
+        lat, lng, _x, _y, props = self.points[pid]
+        out = dict(props)
+        out["lat"] = lat
+        out["lng"] = lng
+        return out
+
+    def expansion_zoom(self, zoom, key):
+        """Smallest zoom at which the cluster in `key` splits into several cells."""
+        count = len(self.levels[zoom][key][2])
+        z, cx, cy = zoom, key[0], key[1]
+        while z < self.max_zoom:
+            z += 1
+            cx, cy = cx * 2, cy * 2
+            cells = self.levels[z]
+            for k in ((cx, cy), (cx + 1, cy), (cx, cy + 1), (cx + 1, cy + 1)):
+                child = cells.get(k)
+                if child is not None and len(child[2]) == count:
+                    cx, cy = k
+                    break
+            else:
+                return z
+        return self.max_zoom + 1
+
+    def get_clusters(self, zoom, west, south, east, north):
+        """Clusters and single points intersecting the bounds at `zoom`.
+
+        Longitudes may run past +/-180 (Leaflet bounds across the antimeridian); such
+        views are split into two ranges. Returns {"clusters": [{key, lat, lng, count,
+        expansion_zoom}], "points": [{id, lat, lng, ...props}]}.
+        """
+        zoom = int(math.floor(zoom))
+        if east - west >= 360:
+            ranges = [(-180.0, 180.0)]
+        else:
+            span = east - west
+            west = (west + 180.0) % 360.0 - 180.0
+            east = west + span
+            ranges = [(west, min(east, 180.0))]
+            if east > 180.0:
+                ranges.append((-180.0, east - 360.0))
+        clusters, points = [], []
+        for w, e in ranges:
+            part = self._query(zoom, w, south, e, north)
+            clusters.extend(part["clusters"])
+            points.extend(part["points"])
+        return {"clusters": clusters, "points": points}
+
+    def _query(self, zoom, west, south, east, north):
+        """get_clusters() for a longitude range within [-180, 180]."""
+        if zoom > self.max_zoom:
+            x0, y0 = _project(north, west)
+            x1, y1 = _project(south, east)
+            pts = [self._point_json(pid) for pid, p in self.points.items()
+                   if x0 <= p[2] <= x1 and y0 <= p[3] <= y1]
+            return {"clusters": [], "points": pts}
+
+        zoom = max(zoom, self.min_zoom)
+        cells = self.levels[zoom]
+        x0, y0 = _project(north, west)
+        x1, y1 = _project(south, east)
+        (cx0, cy0), (cx1, cy1) = self._cell(x0, y0, zoom), self._cell(x1, y1, zoom)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(cells):
+            keys = [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)
+                    if (cx, cy) in cells]
+        else:
+            keys = [k for k in cells if cx0 <= k[0] <= cx1 and cy0 <= k[1] <= cy1]
+
+        clusters, points = [], []
+        for key in keys:
+            sx, sy, ids = cells[key]
+            count = len(ids)
+            if count == 1:
+                points.extend(self._point_json(pid) for pid in ids)
+                continue
+            lat, lng = _unproject(sx / count, sy / count)
+            clusters.append({
+                "key": "%d/%d/%d" % (zoom, key[0], key[1]),
+                "lat": lat, "lng": lng, "count": count,
+                "expansion_zoom": self.expansion_zoom(zoom, key),
+            })
+        return {"clusters": clusters, "points": points}
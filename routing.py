@@ -0,0 +1,273 @@
+import math
+import time
+from array import array
+from heapq import heappush, heappop
+
+from geometry import merge_collinear
+
+# Terrain-aware least-cost routing between two points over the DEM.
+# A corridor window around the two points is sampled into a grid (at most MAX_CELLS
+# cells, coarser cells for longer corridors), per-direction move costs for the
+# 8-neighbourhood are precomputed with NumPy, and A* runs over the flat cost rasters.
+# Move cost = 3-D step length * (1 + SLOPE_WEIGHT * grade); steps steeper than the
+# optional maximum grade are impassable. Large corridors are searched coarse-to-fine:
+# A* on a COARSE_FACTOR times coarser grid first, then at full resolution only within
+# BAND_CELLS coarse cells of that route (the whole corridor if the band has no route).
+
+try:
+    import numpy as np  # type: ignore
+    _routing_available = True
+except Exception as _routing_err:
+    print(f"[Routing] numpy not available: {_routing_err}")
+    _routing_available = False
+
+MAX_CELLS = 2_000_000
+MIN_CELL_M = 10.0           # no point in going finer than typical DEM resolution
+CORRIDOR_MARGIN = 0.25      # corridor padding as a fraction of the point-to-point span
+MIN_PAD_M = 300.0
+SLOPE_WEIGHT = 10.0         # a 10 % grade doubles the cost of a step
+HEURISTIC_WEIGHT = 1.0      # > 1 trades optimality for speed
+COARSE_FACTOR = 4
+COARSE_MIN_CELLS = 250_000  # smaller corridors are searched in one pass
+BAND_CELLS = 3
+PROFILE_SAMPLES = 300
+CANCEL_CHECK_EVERY = 20000  # expansions between checks of the cancelled() callback
+M_PER_DEG = 111320.0
+
+# (drow, dcol) of the 8 neighbours
+_DIRECTIONS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def _merc_y(lat):
+    s = math.sin(math.radians(lat))
+    return 0.5 * math.log((1 + s) / (1 - s))
+
+
+def plan_corridor(start, end, margin=CORRIDOR_MARGIN, max_cells=MAX_CELLS, min_cell_m=MIN_CELL_M):
+    """Bounds (west, south, east, north) and grid size (width, height) of the search window."""
+    (lat0, lng0), (lat1, lng1) = start, end
+    m_lng = M_PER_DEG * math.cos(math.radians((lat0 + lat1) / 2))
+    span_x = abs(lng1 - lng0) * m_lng
+    span_y = abs(lat1 - lat0) * M_PER_DEG
+    pad = max(MIN_PAD_M, margin * max(span_x, span_y))
+    width_m, height_m = span_x + 2 * pad, span_y + 2 * pad
+    cell = max(min_cell_m, math.sqrt(width_m * height_m / max_cells))
+    width = max(3, int(width_m / cell) + 1)
+    height = max(3, int(height_m / cell) + 1)
+    west = min(lng0, lng1) - pad / m_lng
+    east = max(lng0, lng1) + pad / m_lng
+    south = min(lat0, lat1) - pad / M_PER_DEG
+    north = max(lat0, lat1) + pad / M_PER_DEG
+    return (west, south, east, north), (width, height)
+
+
+def cost_rasters(elev, row_lats, lng_step, slope_weight=SLOPE_WEIGHT, max_grade=None):
+    """Move costs (8, (H+2)*(W+2)) for every direction, on a grid padded with one NaN cell.
+
+    cost[d][i] is the cost of stepping from flat cell i to i + offset[d]; inf where
+    either cell has no data or the step is steeper than `max_grade`.
+    """
+    h, w = elev.shape
+    pw = w + 2
+    padded = np.full((h + 2, pw), np.nan, dtype=np.float32)
+    padded[1:-1, 1:-1] = elev
+    lats = np.concatenate([[row_lats[0]], row_lats, [row_lats[-1]]])
+    dx_row = (lng_step * M_PER_DEG * np.cos(np.radians(lats))).astype(np.float32)  # metres per column
+    lat_m = (lats * M_PER_DEG).astype(np.float64)
+
+    costs = np.full((8, h + 2, pw), np.inf, dtype=np.float32)
+    src = padded[1:-1, 1:-1]
+    for d, (dr, dc) in enumerate(_DIRECTIONS):
+        dst = padded[1 + dr:h + 1 + dr, 1 + dc:w + 1 + dc]
+        dy = np.abs(lat_m[1 + dr:h + 1 + dr] - lat_m[1:h + 1]).astype(np.float32)[:, None]
+        dx = (dx_row[1:h + 1] * abs(dc))[:, None]
+        run = np.sqrt(dx * dx + dy * dy)
+        dz = dst - src
+        with np.errstate(invalid="ignore"):
+            grade = np.abs(dz) / run
+            step = np.sqrt(run * run + dz * dz) * (1.0 + slope_weight * grade)
+            blocked = np.isnan(step)
+            if max_grade is not None:
+                blocked |= grade > max_grade
+        costs[d, 1:-1, 1:-1] = np.where(blocked, np.inf, step)
+    return costs.reshape(8, -1), pw
+
+
+def astar(costs, width, start, goal, scale_x, scale_y, weight=HEURISTIC_WEIGHT, cancelled=None):
+    """A* over flat cost rasters; returns (node list start..goal or None, expanded count).
+
+    The heuristic is the straight-line distance using the smallest cell sizes
+    (scale_x, scale_y in metres), which never overestimates a step's cost. The search
+    gives up (returns None) as soon as `cancelled()` is true.
+    """
+    inf = float("inf")
+    n = costs.shape[1]
+    offsets = [dr * width + dc for dr, dc in _DIRECTIONS]
+    rasters = [memoryview(np.ascontiguousarray(costs[d])) for d in range(8)]
+    moves = list(zip(rasters, offsets))
+    g = array("d", [inf]) * n
+    parent = array("i", [-1]) * n
+    closed = bytearray(n)
+
+    # heuristic for every cell, precomputed once instead of per push
+    gr, gc = divmod(goal, width)
+    rows, cols = np.divmod(np.arange(n, dtype=np.int64), width)
+    hx, hy = (cols - gc) * scale_x, (rows - gr) * scale_y
+    heuristic = memoryview((weight * np.sqrt(hx * hx + hy * hy)).astype(np.float64))
+    del rows, cols, hx, hy
+
+    g[start] = 0.0
+    heap = [(0.0, 0.0, start)]
+    expanded = 0
+    while heap:
+        _f, gs, node = heappop(heap)
+        if closed[node]:
+            continue
+        if node == goal:
+            break
+        closed[node] = 1
+        expanded += 1
+        if cancelled is not None and expanded % CANCEL_CHECK_EVERY == 0 and cancelled():
+            return None, expanded
+        for raster, off in moves:
+            step = raster[node]
+            if step == inf:
+                continue
+            nb = node + off
+            ng = gs + step
+            if ng < g[nb] and not closed[nb]:
+                g[nb] = ng
+                parent[nb] = node
+                heappush(heap, (ng + heuristic[nb], ng, nb))
+    if g[goal] == inf:
+        return None, expanded
+    path = [goal]
+    while path[-1] != start:
+        path.append(parent[path[-1]])
+    path.reverse()
+    return path, expanded
+
+
+def _search(elev, row_lats, lng_step, start, goal, slope_weight, max_grade, cancelled=None):
+    """A* between grid cells (row, col); returns ([(row, col), ...] or None, expanded)."""
+    costs, pw = cost_rasters(elev, row_lats, lng_step, slope_weight, max_grade)
+    scale_x = lng_step * M_PER_DEG * float(np.cos(np.radians(np.abs(row_lats).max())))
+    scale_y = float(np.abs(np.diff(row_lats)).min()) * M_PER_DEG
+    (r0, c0), (r1, c1) = start, goal
+    path, expanded = astar(costs, pw, (r0 + 1) * pw + c0 + 1, (r1 + 1) * pw + c1 + 1, scale_x, scale_y,
+                           cancelled=cancelled)
+    if path is None:
+        return None, expanded
+    return [(p // pw - 1, p % pw - 1) for p in path], expanded
+
+
+def _coarse_band(elev, row_lats, lng_step, start, goal, slope_weight, max_grade, cancelled=None):
+    """Mask of the cells within BAND_CELLS coarse cells of the coarse-grid route, or None."""
+    f = COARSE_FACTOR
+    h, w = elev.shape
+    coarse = elev[::f, ::f]
+    cells, expanded = _search(coarse, row_lats[::f], lng_step * f,
+                              (start[0] // f, start[1] // f), (goal[0] // f, goal[1] // f),
+                              slope_weight, max_grade, cancelled)
+    if cells is None:
+        return None, expanded
+    mask = np.zeros(coarse.shape, dtype=bool)
+    rows, cols = zip(*cells)
+    mask[list(rows), list(cols)] = True
+    for _ in range(BAND_CELLS):
+        grown = mask.copy()
+        grown[1:, :] |= mask[:-1, :]
+        grown[:-1, :] |= mask[1:, :]
+        grown[:, 1:] |= mask[:, :-1]
+        grown[:, :-1] |= mask[:, 1:]
+        mask = grown
+    return np.repeat(np.repeat(mask, f, axis=0), f, axis=1)[:h, :w], expanded
+
+
+def find_route(grid_fn, start, end, max_grade=None, slope_weight=SLOPE_WEIGHT, max_cells=MAX_CELLS,
+               cancelled=None):
+    """Least-cost route between start/end (lat, lng) over the DEM.
+
+    `grid_fn(west, south, east, north, width, height)` returns the elevation grid
+    (rows regular in Web Mercator, row 0 north, NaN = no data). Returns a dict with
+    the simplified route [[lat, lng], ...] and its profile, or {"error": ...};
+    {"error": "cancelled"} once the optional `cancelled()` callback returns true.
+    """
+    if not _routing_available:
+        return {"error": "numpy_unavailable"}
+    t0 = time.time()
+    (west, south, east, north), (w, h) = plan_corridor(start, end, max_cells=max_cells)
+    elev = grid_fn(west, south, east, north, w, h)
+    if elev is None:
+        return {"error": "dem_unavailable"}
+    if cancelled is not None and cancelled():
+        return {"error": "cancelled"}
+    elev = np.asarray(elev, dtype=np.float32)
+
+    y_n, y_s = _merc_y(north), _merc_y(south)
+    row_lats = np.degrees(2 * np.arctan(np.exp(np.linspace(y_n, y_s, h))) - np.pi / 2)
+    lng_step = (east - west) / (w - 1)
+
+    def cell_of(lat, lng):
+        r = int(round((y_n - _merc_y(lat)) / (y_n - y_s) * (h - 1)))
+        c = int(round((lng - west) / lng_step))
+        return min(h - 1, max(0, r)), min(w - 1, max(0, c))
+
+    a, b = cell_of(*start), cell_of(*end)
+    if np.isnan(elev[a]) or np.isnan(elev[b]):
+        return {"error": "endpoint_outside_dem"}
+
+    t1 = time.time()
+    cells, expanded = None, 0
+    if w * h >= COARSE_MIN_CELLS:
+        band, expanded = _coarse_band(elev, row_lats, lng_step, a, b, slope_weight, max_grade, cancelled)
+        if band is not None:
+            cells, n = _search(np.where(band, elev, np.nan), row_lats, lng_step, a, b,
+                               slope_weight, max_grade, cancelled)
+            expanded += n
+    if cells is None and not (cancelled is not None and cancelled()):
+        cells, n = _search(elev, row_lats, lng_step, a, b, slope_weight, max_grade, cancelled)
+        expanded += n
+    if cancelled is not None and cancelled():
+        return {"error": "cancelled"}
+    if cells is None:
+        return {"error": "no_route", "cells": w * h, "expanded": expanded}
+
+    lats = [float(row_lats[r]) for r, _c in cells]
+    lngs = [west + c * lng_step for _r, c in cells]
+    zs = [float(elev[r, c]) for r, c in cells]
+
+    dists, ascent, descent, steepest = [0.0], 0.0, 0.0, 0.0
+    for i in range(1, len(cells)):
+        run = math.hypot((lngs[i] - lngs[i - 1]) * M_PER_DEG * math.cos(math.radians(lats[i])),
+                         (lats[i] - lats[i - 1]) * M_PER_DEG)
+        dz = zs[i] - zs[i - 1]
+        dists.append(dists[-1] + run / 1000.0)
+        if dz > 0:
+            ascent += dz
+        else:
+            descent -= dz
+        if run > 0:
+            steepest = max(steepest, abs(dz) / run)
+
+    # only straight runs are merged, so the line stays on the searched cells and matches the profile
+    keep = merge_collinear(cells)
+    route = [[round(float(row_lats[r]), 7), round(west + c * lng_step, 7)] for r, c in keep]
+
+    step = max(1, len(cells) // PROFILE_SAMPLES)
+    idx = list(range(0, len(cells), step))
+    if idx[-1] != len(cells) - 1:
+        idx.append(len(cells) - 1)
+    return {
+        "route": route,
+        "distances_km": [dists[i] for i in idx],
+        "elevations": [zs[i] for i in idx],
+        "length_km": dists[-1],
+        "ascent_m": ascent,
+        "descent_m": descent,
+        "max_grade": steepest,
+        "cells": w * h,
+        "expanded": expanded,
+        "search_s": round(time.time() - t1, 3),
+        "total_s": round(time.time() - t0, 3),
+    }
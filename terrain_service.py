@@ -0,0 +1,578 @@
+import hashlib
+import os
+import sys
+import platform
+import subprocess
+import stat
+import tempfile
+import threading
+import time
+import math
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.connection import Listener, Client
+
+# Local terrain service shared by every running copy of the app.
+# One background process owns the DEM handles and an in-memory LRU cache of DEM blocks
+# (private to the service, so nothing outlives it if it is killed); GUI processes talk to
+# it through TerrainClient over a named pipe (Windows) or a unix socket in a private
+# per-user directory. Both ends authenticate
+# with a random key stored in that directory before any (pickled) message is exchanged.
+# If the service cannot be reached the client returns None and the caller falls back to
+# in-process sampling.
+
+SERVICE_FLAG = "--terrain-service"
+BLOCK_SIZE = 256            # DEM block edge in pixels
+CACHE_SLOTS = 256           # 256 blocks of 256x256 float32 = 64 MiB
+IDLE_SHUTDOWN_S = 600       # service exits after this long without clients
+REQUEST_TIMEOUT_S = 10.0
+ROUTE_TIMEOUT_S = 120.0
+RETRY_AFTER_S = 30.0        # don't try to reach/spawn the service again before this
+DECIMATE_PX = 2.0           # grids coarser than this many DEM pixels are read decimated
+
+_terrain_available = False
+try:
+    import numpy as np  # type: ignore
+    import rasterio  # type: ignore
+    from rasterio.windows import Window  # type: ignore
+    from pyproj import Transformer  # type: ignore
+    _terrain_available = True
+except Exception as _terrain_err:
+    print(f"[Terrain] service dependencies not available: {_terrain_err}")
+
+
+def _runtime_dir():
+    """Per-user directory for the service socket and key, readable by the user only."""
+    if platform.system() == "Windows":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        path = os.path.join(base, "LeafletMap")
+        os.makedirs(path, exist_ok=True)
+        return path
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime and os.path.isdir(runtime):
+        path = os.path.join(runtime, "leafletmap")
+    else:
+        path = os.path.join(tempfile.gettempdir(), f"leafletmap-{os.getuid()}")
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"unsafe terrain service directory: {path}")
+    return path
+
+
+def service_authkey():
+    """Random per-user key shared by the clients and the service (created on first use)."""
+    path = os.path.join(_runtime_dir(), "terrain.key")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(path, "rb") as f:
+                key = f.read()
+            if len(key) == 32:
+                return key
+            time.sleep(0.02)  # another process is still writing it
+        raise PermissionError(f"invalid terrain service key: {path}")
+    key = os.urandom(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def service_address():
+    """Per-user address of the terrain service.
+
+    A unix socket in the user's private runtime directory; on Windows a pipe named
+    after the secret key, so other users cannot guess (and squat) it.
+    """
+    if platform.system() == "Windows":
+        token = hashlib.sha256(b"pipe:" + service_authkey()).hexdigest()[:32]
+        return r"\\.\pipe\leafletmap-terrain-" + token
+    return os.path.join(_runtime_dir(), "terrain.sock")
+
+
+def _clean(values):
+    """NaN -> None for JSON."""
+    return [None if v != v else float(v) for v in values]
+
+
+def grid_lonlats(west, south, east, north, width, height):
+    """Lon/lat arrays (height, width) of a grid that is regular in Web Mercator; row 0 is north."""
+    def merc_y(lat):
+        s = math.sin(math.radians(max(-85.05112878, min(85.05112878, lat))))
+        return 0.5 * math.log((1 + s) / (1 - s))
+    ys = np.linspace(merc_y(north), merc_y(south), height)
+    lats = np.degrees(2 * np.arctan(np.exp(ys)) - np.pi / 2)
+    lons = np.linspace(west, east, width)
+    return np.meshgrid(lons, lats)
+
+
+def _pixel_coords(ds, to_dem, lons, lats):
+    """Fractional DEM row/col of each lon/lat, shaped like `lons` (NaN where unprojectable)."""
+    shape = np.shape(lons)
+    xs, ys = to_dem.transform(np.ravel(lons), np.ravel(lats))
+    cols, rows = ~ds.transform * (np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+    return np.reshape(rows, shape), np.reshape(cols, shape)
+
+
+def _pixel_index(ds, rows, cols):
+    """Flat row/col of the DEM pixel under each position and a mask of the ones inside the DEM."""
+    with np.errstate(invalid="ignore"):
+        cols = np.floor(np.nan_to_num(np.ravel(cols), nan=-1.0)).astype(np.int64)
+        rows = np.floor(np.nan_to_num(np.ravel(rows), nan=-1.0)).astype(np.int64)
+    inside = (cols >= 0) & (rows >= 0) & (cols < ds.width) & (rows < ds.height)
+    return rows, cols, inside
+
+
+def _decimation(rows, cols):
+    """Read-decimation factor for a 2-D grid of pixel positions (1 = full resolution).
+
+    The factor is the grid spacing in DEM pixels (the finer of the two axes), so a
+    decimated read still has at least one DEM value per grid cell.
+    """
+    if np.ndim(rows) != 2 or min(np.shape(rows)) < 2:
+        return 1
+    along = np.hypot(np.diff(rows, axis=1), np.diff(cols, axis=1))
+    across = np.hypot(np.diff(rows, axis=0), np.diff(cols, axis=0))
+    along, across = along[np.isfinite(along)], across[np.isfinite(across)]
+    if not along.size or not across.size:
+        return 1
+    step = min(np.median(along), np.median(across))
+    return int(step) if step >= DECIMATE_PX else 1
+
+
+def _read_window(ds, rows, cols, factor=1):
+    """Nearest-neighbour values at pixel positions from one window read, shaped like `rows`.
+
+    With factor > 1 the window is read `factor` times coarser (rasterio out_shape, which
+    uses the file's overviews when it has them) instead of at full resolution.
+    """
+    shape = np.shape(rows)
+    r, c, inside = _pixel_index(ds, rows, cols)
+    out = np.full(r.shape, np.nan, dtype=np.float32)
+    if inside.any():
+        r, c = r[inside], c[inside]
+        r0, c0 = int(r.min()), int(c.min())
+        win_h, win_w = int(r.max()) - r0 + 1, int(c.max()) - c0 + 1
+        out_h, out_w = -(-win_h // factor), -(-win_w // factor)
+        data = ds.read(1, window=Window(c0, r0, win_w, win_h), out_shape=(out_h, out_w)).astype(np.float32)
+        if ds.nodata is not None:
+            data[data == ds.nodata] = np.nan
+        out[inside] = data[(r - r0) * out_h // win_h, (c - c0) * out_w // win_w]
+    return out.reshape(shape)
+
+
+def read_points(ds, to_dem, lons, lats):
+    """In-process nearest-neighbour sampling (no block cache) with a single window read.
+
+    Same result as the service's sampling; used when the service cannot be reached.
+    A lon/lat grid much coarser than the DEM is read at about the grid's resolution.
+    Returns a float32 array shaped like `lons` with NaN for nodata/outside.
+    """
+    rows, cols = _pixel_coords(ds, to_dem, lons, lats)
+    return _read_window(ds, rows, cols, _decimation(rows, cols))
+
+
+# ---------------------------------------------------------------- server side
+
+class BlockCache:
+    """LRU cache of DEM blocks stored in one preallocated array."""
+
+    def __init__(self, slots=CACHE_SLOTS, block=BLOCK_SIZE):
+        self.block = block
+        self.blocks = np.empty((slots, block, block), dtype=np.float32)
+        self.slot_of = OrderedDict()    # (path, bx, by) -> slot, oldest first
+        self.free = list(range(slots))
+
+    def get(self, dem, bx, by):
+        """Block (bx, by) of `dem` as a view into the cache; nodata is NaN."""
+        key = (dem.path, bx, by)
+        slot = self.slot_of.get(key)
+        if slot is not None:
+            self.slot_of.move_to_end(key)
+            return self.blocks[slot]
+        if self.free:
+            slot = self.free.pop()
+        else:
+            _old, slot = self.slot_of.popitem(last=False)
+        out = self.blocks[slot]
+        out.fill(np.nan)
+        b = self.block
+        col0, row0 = bx * b, by * b
+        w = min(b, dem.ds.width - col0)
+        h = min(b, dem.ds.height - row0)
+        if w > 0 and h > 0:
+            data = dem.ds.read(1, window=Window(col0, row0, w, h)).astype(np.float32)
+            if dem.nodata is not None:
+                data[data == dem.nodata] = np.nan
+            out[:h, :w] = data
+        self.slot_of[key] = slot
+        return out
+
+    def close(self):
+        self.blocks = None
+        self.slot_of = OrderedDict()
+
+
+class _Dem:
+    def __init__(self, path):
+        self.path = path
+        self.ds = rasterio.open(path)
+        self.to_dem = Transformer.from_crs("EPSG:4326", self.ds.crs, always_xy=True)
+        self.nodata = self.ds.nodata
+        print(f"[Terrain] DEM opened: {path}")
+
+
+class TerrainServer:
+    """Owns DEM handles and the block cache; one lock serialises DEM access."""
+
+    def __init__(self):
+        self.dems = {}
+        self.cache = BlockCache()
+        self.lock = threading.Lock()
+
+    def _dem(self, path):
+        dem = self.dems.get(path)
+        if dem is None:
+            dem = self.dems[path] = _Dem(path)
+        return dem
+
+    def sample_array(self, path, lons, lats):
+        """Nearest-neighbour elevations, shaped like `lons` (NaN = no data).
+
+        Points go through the block cache; a 2-D grid much coarser than the DEM is read
+        decimated straight from the file instead, so it doesn't flush the cache.
+        """
+        b = self.cache.block
+        with self.lock:
+            dem = self._dem(path)
+            rows_f, cols_f = _pixel_coords(dem.ds, dem.to_dem, lons, lats)
+            factor = _decimation(rows_f, cols_f)
+            if factor > 1:
+                return _read_window(dem.ds, rows_f, cols_f, factor)
+            rows, cols, inside = _pixel_index(dem.ds, rows_f, cols_f)
+            out = np.full(rows.shape, np.nan, dtype=np.float32)
+            idx = np.nonzero(inside)[0]
+            if len(idx):
+                r, c = rows[idx], cols[idx]
+                keys = (r // b) * (dem.ds.width // b + 1) + c // b
+                order = np.argsort(keys, kind="stable")
+                bounds = np.nonzero(np.diff(keys[order]))[0] + 1
+                for group in np.split(order, bounds):
+                    block = self.cache.get(dem, int(c[group[0]] // b), int(r[group[0]] // b))
+                    out[idx[group]] = block[r[group] % b, c[group] % b]
+        return out.reshape(np.shape(lons))
+
+    def sample(self, path, lons, lats):
+        """Nearest-neighbour elevations for lon/lat lists (None outside the DEM)."""
+        return _clean(self.sample_array(path, lons, lats))
+
+    def grid(self, path, west, south, east, north, width, height):
+        lons, lats = grid_lonlats(west, south, east, north, int(width), int(height))
+        return self.sample_array(path, lons, lats)
+
+    def handle(self, req):
+        op = req.get("op")
+        try:
+            if op == "ping":
+                return {"ok": True, "pid": os.getpid()}
+            if op == "sample":
+                return {"elevations": self.sample(req["dem"], req["lons"], req["lats"])}
+            if op == "grid":
+                return {"grid": self.grid(req["dem"], req["west"], req["south"], req["east"],
+                                          req["north"], req["width"], req["height"])}
+            if op == "route":
+                from routing import find_route
+                return find_route(lambda *bounds: self.grid(req["dem"], *bounds),
+                                  tuple(req["start"]), tuple(req["end"]), max_grade=req.get("max_grade"))
+            if op == "contours":
+                from contours import build_tile
+                return build_tile(lambda *bounds: self.grid(req["dem"], *bounds),
+                                  int(req["z"]), int(req["x"]), int(req["y"]))
+            return {"error": f"unknown_op: {op}"}
+        except Exception as e:
+            return {"error": f"{op}_failed: {e}"}
+
+    def close(self):
+        with self.lock:
+            for dem in self.dems.values():
+                try:
+                    dem.ds.close()
+                except Exception:
+                    pass
+            self.dems = {}
+            self.cache.close()
+
+
+@contextmanager
+def _startup_lock():
+    """Exclusive lock (a file in the runtime directory) held while a service starts listening."""
+    with open(os.path.join(_runtime_dir(), "terrain.lock"), "a+b") as f:
+        if platform.system() == "Windows":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after 10 s; keep waiting
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def serve(address=None, idle_timeout=IDLE_SHUTDOWN_S):
+    """Run the terrain service until no client has been connected for `idle_timeout` s."""
+    if not _terrain_available:
+        return
+    address = address or service_address()
+    authkey = service_authkey()
+    # two services starting at once must not both miss the probe and then unlink each other's socket
+    with _startup_lock():
+        try:
+            Client(address, authkey=authkey).close()
+            print("[Terrain] service already running")
+            return
+        except Exception:
+            pass
+        if platform.system() != "Windows" and os.path.exists(address):
+            os.unlink(address)  # stale socket from a crashed service
+        listener = Listener(address, authkey=authkey)
+    server = TerrainServer()
+    state = {"clients": 0, "last_seen": time.time()}
+    state_lock = threading.Lock()
+    print(f"[Terrain] service listening on {address} (pid {os.getpid()})")
+
+    def client_loop(conn):
+        try:
+            while True:
+                req = conn.recv()
+                conn.send(server.handle(req))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            with state_lock:
+                state["clients"] -= 1
+                state["last_seen"] = time.time()
+
+    def idle_watch():
+        while True:
+            time.sleep(5)
+            with state_lock:
+                idle = state["clients"] == 0 and time.time() - state["last_seen"] > idle_timeout
+            if idle:
+                print("[Terrain] idle, shutting down")
+                server.close()
+                try:
+                    listener.close()
+                except Exception:
+                    pass
+                os._exit(0)
+
+    threading.Thread(target=idle_watch, daemon=True).start()
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            print(f"[Terrain] accept failed: {e}")
+            continue
+        with state_lock:
+            state["clients"] += 1
+        threading.Thread(target=client_loop, args=(conn,), daemon=True).start()
+
+
+# ---------------------------------------------------------------- client side
+
+def _service_command():
+    if getattr(sys, "frozen", False):
+        # PyInstaller build: the app executable starts the service when given SERVICE_FLAG
+        return [sys.executable, SERVICE_FLAG]
+    return [sys.executable, os.path.abspath(__file__), SERVICE_FLAG]
+
+
+_spawn_lock = threading.Lock()
+_spawned_at = 0.0
+
+
+def _spawn_service():
+    """Start the service process, at most once per RETRY_AFTER_S for this process."""
+    global _spawned_at
+    with _spawn_lock:
+        if time.time() - _spawned_at < RETRY_AFTER_S:
+            return False
+        _spawned_at = time.time()
+    kwargs = {"stdin": subprocess.DEVNULL, "stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    if platform.system() == "Windows":
+        kwargs["creationflags"] = 0x00000008 | 0x00000200 | 0x08000000  # DETACHED | NEW_GROUP | NO_WINDOW
+    else:
+        kwargs["start_new_session"] = True
+    subprocess.Popen(_service_command(), **kwargs)
+    print("[Terrain] service started")
+    return True
+
+
+class TerrainClient:
+    """Thin client for the terrain service; every call returns None on failure.
+
+    Connecting (and starting the service) happens in a background thread, so requests
+    never wait for it unless they ask to: while the service is coming up they return
+    None and the caller uses its in-process fallback.
+    """
+
+    def __init__(self, dem_path, address=None, autostart=True, timeout=REQUEST_TIMEOUT_S):
+        self.dem_path = dem_path
+        self.address = address
+        self.autostart = autostart
+        self.timeout = timeout
+        self.conn = None
+        self.lock = threading.Lock()            # one request at a time on self.conn
+        self._connect_lock = threading.Lock()
+        self._connecting = False
+        self._retry_at = 0.0
+        self.failed = False                     # last connect attempt could not reach/start the service
+
+    def _open(self):
+        address = self.address or service_address()
+        authkey = service_authkey()
+        try:
+            return Client(address, authkey=authkey)
+        except Exception:
+            if not self.autostart:
+                raise
+        _spawn_service()
+        deadline = time.time() + self.timeout
+        while True:
+            time.sleep(0.2)
+            try:
+                return Client(address, authkey=authkey)
+            except Exception:
+                if time.time() > deadline:
+                    raise
+
+    def connect(self):
+        """Connect, starting the service if needed; True when it is reachable.
+
+        Blocks for up to `timeout` seconds, so call it off the UI thread (see connect_async).
+        """
+        with self._connect_lock:
+            if self.conn is not None:
+                return True
+            if not _terrain_available or time.time() < self._retry_at:
+                return False
+            try:
+                conn = self._open()
+            except Exception as e:
+                print(f"[Terrain] service unreachable, using in-process DEM: {e}")
+                self._retry_at = time.time() + RETRY_AFTER_S
+                self.failed = True
+                return False
+            with self.lock:
+                self.conn = conn
+            self.failed = False
+            return True
+
+    def unavailable(self):
+        """True when the service cannot be used (dependencies missing or it could not be
+        reached/started), as opposed to merely not being connected yet."""
+        return not _terrain_available or self.failed
+
+    def connect_async(self):
+        """Start connecting in a background thread unless that is already under way."""
+        if self._connecting or self.conn is not None:
+            return
+        self._connecting = True
+
+        def run():
+            try:
+                self.connect()
+            finally:
+                self._connecting = False
+        threading.Thread(target=run, daemon=True).start()
+
+    def request(self, op, timeout=None, wait=False, **kwargs):
+        """Send one request and return the reply, or None when the service is unavailable.
+
+        Without a connection the call returns None at once and connects in the
+        background; with `wait` it connects in the calling thread instead.
+        """
+        if not _terrain_available or time.time() < self._retry_at:
+            return None
+        if self.conn is None:
+            if not wait:
+                self.connect_async()
+                return None
+            if not self.connect():
+                return None
+        req = dict(kwargs, op=op)
+        timeout = timeout or self.timeout
+        with self.lock:
+            if self.conn is None:
+                return None
+            try:
+                self.conn.send(req)
+                if not self.conn.poll(timeout):
+                    raise TimeoutError(f"{op} timed out")
+                return self.conn.recv()
+            except Exception as e:
+                print(f"[Terrain] {op} request failed: {e}")
+                self.close_connection()
+        self.connect_async()
+        return None
+
+    def close_connection(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+    def sample(self, lons, lats):
+        res = self.request("sample", dem=self.dem_path, lons=list(lons), lats=list(lats))
+        if not res or "error" in res:
+            return None
+        return res["elevations"]
+
+    def grid(self, west, south, east, north, width, height):
+        """Elevation grid (see grid_lonlats) as a float32 array, NaN where there is no data."""
+        res = self.request("grid", dem=self.dem_path, west=west, south=south, east=east,
+                           north=north, width=width, height=height)
+        if not res or "error" in res:
+            return None
+        return res["grid"]
+
+    def contours(self, z, x, y):
+        """Contour tile z/x/y built in the service (see contours.build_tile).
+
+        Returns {"error": ...} when the build failed in the service, or None when the
+        service is not connected (yet).
+        """
+        return self.request("contours", dem=self.dem_path, z=z, x=x, y=y)
+
+    def route(self, start, end, max_grade=None):
+        """Least-cost route computed in the service (see routing.find_route).
+
+        Waits for the connection (call it from a worker thread). Returns the result
+        dict, including routing errors such as no_route, or None when the service
+        cannot be reached.
+        """
+        return self.request("route", timeout=ROUTE_TIMEOUT_S, wait=True, dem=self.dem_path,
+                            start=list(start), end=list(end), max_grade=max_grade)
+
+
+if __name__ == "__main__":
+    serve()
@@ -28,7 +28,12 @@ var baseLayers = {
     "OpenTopo": opentopo,
     "Topo": topo
 };
-L.control.layers(baseLayers, null, { position: 'bottomright' }).addTo(map);
+// Contour lines generated in Python from the local DEM (see contours.py)
+var contourLayer = L.layerGroup();
+var overlays = {
+    "Contours (DEM)": contourLayer
+};
+L.control.layers(baseLayers, overlays, { position: 'bottomright' }).addTo(map);
 
 // Feature group for drawn items
 var drawnItems = new L.FeatureGroup();
@@ -247,7 +252,9 @@ async function fetchElevationProfile(polyline) {
     // Offline first (CEF/Python)
     if (window.cefPythonBindings && window.cefPythonBindings.getElevations) {
         try {
-            const resStr = await window.cefPythonBindings.getElevations(JSON.stringify(pts));
+            // bindings cannot return values: Python answers through the callback
+            const resStr = await new Promise(resolve =>
+                window.cefPythonBindings.getElevations(JSON.stringify(pts), resolve));
             const data = JSON.parse(resStr);
             if (data && Array.isArray(data.elevations)) elevations = data.elevations;
         } catch (e) { /* ignore */ }
@@ -296,6 +303,70 @@ async function fetchElevationProfile(polyline) {
     }
 }
 
+// ===== Contour overlay =====
+// Python builds one tile of contour lines at a time and pushes it with addContourTile();
+// tiles that leave the view are cancelled there and dropped here (both sides work out the
+// visible tiles themselves, the binding returns nothing to the page).
+const contourTiles = new Map();   // "z/x/y" -> L.layerGroup of that tile's lines
+
+function contourZoom() { return Math.min(Math.floor(map.getZoom()), 17); }
+
+// "z/x/y" keys of the tiles covering the view (same as contours.tiles_for_bounds)
+function contourTileKeys() {
+    const z = contourZoom(), keys = new Set();
+    if (z < 10) return keys;
+    const n = 2 ** z, b = map.getBounds();
+    const tx = lng => Math.min(n - 1, Math.max(0, Math.floor((lng + 180) / 360 * n)));
+    const ty = lat => {
+        const r = Math.max(-85.05112878, Math.min(85.05112878, lat)) * Math.PI / 180;
+        return Math.min(n - 1, Math.max(0, Math.floor((1 - Math.log(Math.tan(r) + 1 / Math.cos(r)) / Math.PI) / 2 * n)));
+    };
+    for (let y = ty(b.getNorth()); y <= ty(b.getSouth()); y++)
+        for (let x = tx(b.getWest()); x <= tx(b.getEast()); x++) keys.add(`${z}/${x}/${y}`);
+    return keys;
+}
+
+function addContourTile(key, tileJson) {
+    if (!map.hasLayer(contourLayer) || contourTiles.has(key)) return;
+    if (!contourTileKeys().has(key)) return;
+    let tile;
+    try { tile = JSON.parse(tileJson); } catch (e) { return; }
+    const group = L.layerGroup();
+    tile.lines.forEach(line => {
+        L.polyline(line.coords, {
+            color: '#8d5524', weight: line.major ? 1.6 : 0.8,
+            opacity: line.major ? 0.85 : 0.6, interactive: false
+        }).addTo(group);
+    });
+    contourTiles.set(key, group);
+    group.addTo(contourLayer);
+}
+
+function dropContourTiles(keep) {
+    contourTiles.forEach((group, key) => {
+        if (!keep(key)) {
+            contourLayer.removeLayer(group);
+            contourTiles.delete(key);
+        }
+    });
+}
+
+function refreshContours() {
+    if (!map.hasLayer(contourLayer) || !(window.cefPythonBindings && window.cefPythonBindings.requestContours)) return;
+    const wanted = contourTileKeys();
+    dropContourTiles(key => wanted.has(key));
+    const b = map.getBounds();
+    const bounds = { west: b.getWest(), south: b.getSouth(), east: b.getEast(), north: b.getNorth() };
+    window.cefPythonBindings.requestContours(map.getZoom(), JSON.stringify(bounds));
+}
+map.on('moveend', refreshContours);
+map.on('overlayadd', e => { if (e.layer === contourLayer) refreshContours(); });
+map.on('overlayremove', e => {
+    if (e.layer !== contourLayer) return;
+    dropContourTiles(() => false);
+    if (window.cefPythonBindings && window.cefPythonBindings.cancelContours) window.cefPythonBindings.cancelContours();
+});
+
 // ===== Live dots along the line while dragging =====
 const liveOverlay = L.layerGroup().addTo(map);
 const liveLineDots = {
@@ -341,6 +412,10 @@ function linkMarkersWithPolyline(marker1, marker2, polyline) {
     marker1._linkedPolylines.add(polyline);
     marker2._linkedPolylines.add(polyline);
 
+    // linked markers must stay on the map, take them out of the cluster index
+    markerCluster.release(marker1);
+    markerCluster.release(marker2);
+
     attachMarkerLineSync(marker1);
     attachMarkerLineSync(marker2);
 }
@@ -413,6 +488,7 @@ function attachMarkerLineSync(marker) {
     modernGraph.hide();
     modernGraph.activeLine = null;
         liveLineDots.clear();
+        markerCluster.moved(marker);
     });
 }
 
@@ -447,6 +523,9 @@ map.on(L.Draw.Event.CREATED, function (e) {
     attachMarkerLineSync(layer);
     }
     layer._shapeId = generateShapeId();
+    if (type === "marker") {
+        markerCluster.register(layer);
+    }
 
     // Bind appropriate popup based on shape type
     if (type === 'polyline') {
@@ -460,6 +539,19 @@ map.on(L.Draw.Event.CREATED, function (e) {
     }
 });
 
+// Keep the cluster index in step with markers deleted or moved via the draw toolbar
+map.on(L.Draw.Event.DELETED, function (e) {
+    e.layers.eachLayer(function (layer) {
+        if (layer instanceof L.Marker) markerCluster.release(layer);
+    });
+});
+
+map.on(L.Draw.Event.EDITED, function (e) {
+    e.layers.eachLayer(function (layer) {
+        if (layer instanceof L.Marker) markerCluster.moved(layer);
+    });
+});
+
 // Save original addVertex once
 const origPolylineAddVertex = L.Draw.Polyline.prototype.addVertex;
 
@@ -591,9 +683,12 @@ function bindShapePopup(shape, shapeType) {
     });
 }
 
-function bindPolylinePopup(polyline) {
+function bindPolylinePopup(polyline, withRoute) {
     const latlngs = polyline.getLatLngs();
-    
+    const routeControls = withRoute ? `<br><br>
+            <input id='route-max-grade' type='number' min='1' step='1' placeholder='Max grade %'>
+            <button id='terrain-route-btn'>Terrain Route</button>` : '';
+
     const result = getDistanceAndAngle(latlngs[0], latlngs[1]);
     polyline.bindPopup(
         `<div>
@@ -602,13 +697,14 @@ function bindPolylinePopup(polyline) {
             Distance: ${result.distance.toFixed(2)} km<br>
             Angle: ${result.angle.toFixed(2)}°<br><br>
             <button id='change-polyline-color'>Change Color</button><br><br>
-            <button id='show-polyline-graph'>Show Graph</button>
+            <button id='show-polyline-graph'>Show Graph</button>${routeControls}
         </div>`
     );
     polyline.on('popupopen', function () {
         const deleteBtn = document.getElementById('delete-polyline-btn');
         const colorBtn = document.getElementById('change-polyline-color');
         const graphBtn = document.getElementById('show-polyline-graph');
+        const routeBtn = document.getElementById('terrain-route-btn');
         
         if (deleteBtn) {
             deleteBtn.onclick = function () {
@@ -632,6 +728,13 @@ function bindPolylinePopup(polyline) {
                 polyline.closePopup();
             };
         }
+        if (routeBtn) {
+            routeBtn.onclick = function () {
+                const maxGradePct = parseFloat(document.getElementById('route-max-grade').value);
+                requestTerrainRoute(polyline, maxGradePct);
+                polyline.closePopup();
+            };
+        }
     });
 }
 
@@ -651,6 +754,7 @@ function deselect() {
     drawnItems.eachLayer(function(layer) {
         drawnItems.removeLayer(layer);
     });
+    markerCluster.clear();
 }
 
 
@@ -685,11 +789,18 @@ let selectedMarkers = [];
 let selectionPolylines = [];
 
 function createMarker(latlng) {
+    const marker = buildCustomMarker(latlng);
+    marker._shapeId = generateShapeId("custommarker");
+    markerCluster.register(marker);
+    return marker;
+}
+
+// Pin-icon marker with its popup and line sync, added to drawnItems
+function buildCustomMarker(latlng) {
     const marker = L.marker(latlng, {
         icon: customIcon,
         draggable: true
     });
-    marker._shapeId = generateShapeId("custommarker");
     marker._customType = "custommarker";
     drawnItems.addLayer(marker);
     marker.options.draggable = true;
@@ -705,6 +816,7 @@ function createMarker(latlng) {
 
     marker.on('popupopen', function () {
         document.getElementById('delete-marker-btn').onclick = function () {
+            markerCluster.release(marker);
             drawnItems.removeLayer(marker);
             // selectedMarkers = selectedMarkers.filter(m => m !== marker);
             marker.closePopup();
@@ -718,6 +830,157 @@ function createMarker(latlng) {
     return marker;
 }
 
+// Default Leaflet marker (drawn with the draw toolbar)
+function buildPlainMarker(latlng) {
+    const marker = L.marker(latlng, { draggable: true });
+    marker._customType = "marker";
+    drawnItems.addLayer(marker);
+    marker.dragging.enable();
+    attachMarkerLineSync(marker);
+    return marker;
+}
+
+function materializeMarker(s) {
+    const marker = s.type === "custommarker" ? buildCustomMarker([s.lat, s.lng]) : buildPlainMarker([s.lat, s.lng]);
+    marker._shapeId = s.shapeId;
+    return marker;
+}
+
+// ===== Marker clustering =====
+// The cluster index lives in Python (marker_cluster.py). Every marker is registered
+// there; only markers that are not folded into a cluster at the current zoom and
+// are inside the view exist as real L.markers, the rest are drawn as count bubbles.
+const CLUSTER_MIN_MARKERS = 200; // below this every marker stays a real marker
+const clusterLayer = L.layerGroup().addTo(map);
+const markerCluster = {
+    shapes: new Map(),   // cluster id -> { id, shapeId, type, lat, lng }
+    live: new Map(),     // cluster id -> L.marker currently in drawnItems
+    nextId: 1,
+    seq: 0,              // getMarkerClusters request number; older replies are dropped
+    timer: null,
+
+    available() {
+        return !!(window.cefPythonBindings && window.cefPythonBindings.getMarkerClusters);
+    },
+
+    // Track a marker that is already on the map
+    register(marker) {
+        if (!this.available() || marker._clusterId) return;
+        const ll = marker.getLatLng();
+        const s = { id: this.nextId++, shapeId: marker._shapeId, type: marker._customType || "marker", lat: ll.lat, lng: ll.lng };
+        marker._clusterId = s.id;
+        this.shapes.set(s.id, s);
+        this.live.set(s.id, marker);
+        window.cefPythonBindings.loadClusterMarkers(JSON.stringify([s]));
+        this.schedule();
+    },
+
+    // Bulk load imported marker shapes; real markers are created by refresh()
+    load(shapes) {
+        if (shapes.length === 0) return;
+        const batch = shapes.map(sh => {
+            const ll = L.latLng(sh.latlngs[0]);
+            return { id: this.nextId++, shapeId: sh.id, type: sh.type, lat: ll.lat, lng: ll.lng };
+        });
+        if (!this.available()) {
+            batch.forEach(s => materializeMarker(s));
+            return;
+        }
+        batch.forEach(s => this.shapes.set(s.id, s));
+        window.cefPythonBindings.loadClusterMarkers(JSON.stringify(batch));
+        this.refresh();
+    },
+
+    moved(marker) {
+        const s = marker._clusterId ? this.shapes.get(marker._clusterId) : null;
+        if (!s) return;
+        const ll = marker.getLatLng();
+        s.lat = ll.lat; s.lng = ll.lng;
+        window.cefPythonBindings.moveClusterMarker(s.id, s.lat, s.lng);
+        this.schedule();
+    },
+
+    // Stop clustering a marker (deleted, or linked to a line and must stay visible)
+    release(marker) {
+        const id = marker._clusterId;
+        if (!id) return;
+        marker._clusterId = null;
+        this.shapes.delete(id);
+        this.live.delete(id);
+        if (this.available()) window.cefPythonBindings.removeClusterMarker(id);
+        this.schedule();
+    },
+
+    clear() {
+        this.shapes.clear();
+        this.live.clear();
+        clusterLayer.clearLayers();
+        if (this.available()) window.cefPythonBindings.clearClusterMarkers();
+    },
+
+    // Shapes of markers currently folded into clusters (not in drawnItems)
+    hiddenShapes() {
+        return Array.from(this.shapes.values()).filter(s => !this.live.has(s.id));
+    },
+
+    schedule() {
+        if (this.timer) return;
+        this.timer = setTimeout(() => {
+            this.timer = null;
+            this.refresh();
+        }, 150);
+    },
+
+    async refresh() {
+        let wanted = null, clusters = [];
+        if (this.shapes.size >= CLUSTER_MIN_MARKERS) {
+            const b = map.getBounds().pad(0.25);
+            const bounds = { west: b.getWest(), south: b.getSouth(), east: b.getEast(), north: b.getNorth() };
+            const req = { request_id: ++this.seq, zoom: map.getZoom(), bounds: bounds };
+            // bindings cannot return values: Python answers through the callback
+            const resStr = await new Promise(resolve =>
+                window.cefPythonBindings.getMarkerClusters(JSON.stringify(req), resolve));
+            let data = null;
+            try { data = JSON.parse(resStr); } catch (e) { /* keep every marker real */ }
+            if (data && data.request_id !== this.seq) return; // superseded by a newer refresh
+            if (data && !data.error) {
+                wanted = new Set(data.points.map(p => p.id));
+                clusters = data.clusters;
+            }
+        }
+
+        // fold markers that are clustered or out of view (keep the ones being selected)
+        this.live.forEach((marker, id) => {
+            if (wanted && !wanted.has(id) && !selectedMarkers.includes(marker)) {
+                const s = this.shapes.get(id), ll = marker.getLatLng();
+                s.lat = ll.lat; s.lng = ll.lng;
+                drawnItems.removeLayer(marker);
+                this.live.delete(id);
+            }
+        });
+        // create real markers for the unclustered ones
+        this.shapes.forEach((s, id) => {
+            if ((!wanted || wanted.has(id)) && !this.live.has(id)) {
+                const marker = materializeMarker(s);
+                marker._clusterId = id;
+                this.live.set(id, marker);
+            }
+        });
+
+        clusterLayer.clearLayers();
+        clusters.forEach(c => {
+            const size = c.count < 100 ? 32 : (c.count < 1000 ? 40 : 48);
+            const bubble = L.marker([c.lat, c.lng], {
+                icon: L.divIcon({ className: 'marker-cluster', html: `<div><span>${c.count}</span></div>`, iconSize: [size, size] }),
+                keyboard: false
+            });
+            bubble.on('click', () => map.setView([c.lat, c.lng], Math.min(c.expansion_zoom, map.getMaxZoom())));
+            bubble.addTo(clusterLayer);
+        });
+    }
+};
+map.on('moveend', () => markerCluster.schedule());
+
 function handleMarkerSelection(marker) {
     if (!selectedMarkers.includes(marker)) {
         selectedMarkers.push(marker);
@@ -744,7 +1007,7 @@ function drawLineBetweenMarkers(marker1, marker2) {
     const latlngs = [marker1.getLatLng(), marker2.getLatLng()];
     const polyline = L.polyline(latlngs, { color: 'red', weight: 3 }); 
     drawnItems.addLayer(polyline);
-    bindPolylinePopup(polyline);
+    bindPolylinePopup(polyline, true);
     selectionPolylines.push(polyline);
     updatePolylineColors();
 
@@ -796,6 +1059,91 @@ function updatePolylineColors() {
     }
 }
 
+// ===== Terrain routing between two linked markers (see routing.py) =====
+// Python searches in a worker thread and answers through showTerrainRoute().
+let terrainRouteSeq = 0;
+
+function requestTerrainRoute(polyline, maxGradePct) {
+    const [m1, m2] = polyline._linkedMarkers || [];
+    if (!m1 || !m2) return;
+    if (!(window.cefPythonBindings && window.cefPythonBindings.findTerrainRoute)) {
+        alert("Terrain routing not available!");
+        return;
+    }
+    const a = m1.getLatLng(), b = m2.getLatLng();
+    const req = {
+        request_id: ++terrainRouteSeq,
+        start: { lat: a.lat, lng: a.lng },
+        end: { lat: b.lat, lng: b.lng },
+        max_grade: (isFinite(maxGradePct) && maxGradePct > 0) ? maxGradePct / 100 : null
+    };
+    modernGraph.activeLine = null;
+    modernGraph.setElevationData([], [], 'Finding terrain route...');
+    modernGraph.show();
+    window.cefPythonBindings.findTerrainRoute(JSON.stringify(req));
+}
+
+function terrainRouteStatus(res) {
+    return `Terrain route • ${res.length_km.toFixed(2)} km  +${res.ascent_m.toFixed(0)}/-${res.descent_m.toFixed(0)} m  max ${(res.max_grade * 100).toFixed(0)}%`;
+}
+
+// Called from Python with the routing result
+function showTerrainRoute(resultJson) {
+    let res;
+    try { res = JSON.parse(resultJson); } catch (e) { return; }
+    if (res.request_id !== terrainRouteSeq) return; // superseded by a newer request
+    if (res.error) {
+        const reasons = { no_route: 'no route within the grade limit', endpoint_outside_dem: 'marker outside the DEM', dem_unavailable: 'DEM not available' };
+        modernGraph.setElevationData([], [], 'Terrain route failed: ' + (reasons[res.error] || res.error));
+        return;
+    }
+    const route = L.polyline(res.route, { color: '#2e7d32', weight: 4 });
+    route._shapeId = generateShapeId("polyline");
+    drawnItems.addLayer(route);
+    bindTerrainRoutePopup(route, res);
+    modernGraph.setElevationData(res.distances_km, res.elevations, terrainRouteStatus(res));
+    modernGraph.show();
+}
+
+function bindTerrainRoutePopup(route, res) {
+    route.bindPopup(
+        `<div>
+            <button id='delete-route-btn'>Delete this route</button><br>
+            <b>Terrain Route</b><br>
+            Length: ${res.length_km.toFixed(2)} km<br>
+            Ascent/Descent: +${res.ascent_m.toFixed(0)} / -${res.descent_m.toFixed(0)} m<br>
+            Steepest: ${(res.max_grade * 100).toFixed(1)}%<br><br>
+            <button id='change-route-color'>Change Color</button><br><br>
+            <button id='show-route-graph'>Show Graph</button>
+        </div>`
+    );
+    route.on('popupopen', function () {
+        const deleteBtn = document.getElementById('delete-route-btn');
+        const colorBtn = document.getElementById('change-route-color');
+        const graphBtn = document.getElementById('show-route-graph');
+        if (deleteBtn) {
+            deleteBtn.onclick = function () {
+                drawnItems.removeLayer(route);
+                route.closePopup();
+            };
+        }
+        if (colorBtn) {
+            colorBtn.onclick = function () {
+                openColorPickerForShape(route);
+                route.closePopup();
+            };
+        }
+        if (graphBtn) {
+            graphBtn.onclick = function () {
+                modernGraph.activeLine = route;
+                modernGraph.setElevationData(res.distances_km, res.elevations, terrainRouteStatus(res));
+                modernGraph.show();
+                route.closePopup();
+            };
+        }
+    });
+}
+
 let lastCustomPolyline = null;
 
 function handleCustomPolylineDraw(e) {
@@ -928,35 +1276,12 @@ function importShapes(jsonStr) {
         return;
     }
     // drawnItems.clearLayers();
+    const markerShapes = [];
     shapes.forEach(shape => {
         let layer;
-        if (shape.type === "custommarker") {
-            layer = L.marker(shape.latlngs[0], { icon: customIcon, draggable: true });
-            drawnItems.addLayer(layer);
-            layer.dragging.enable();
-            attachMarkerLineSync(layer);
-            layer.bindPopup(`
-        <button id='delete-marker-btn'>Delete this marker</button><br><br>
-        <button id='select-button'>Select this marker</button>
-         `);
-
-            layer.on('popupopen', function () {
-                document.getElementById('delete-marker-btn').onclick = function () {
-                    drawnItems.removeLayer(layer);
-                    // selectedMarkers = selectedMarkers.filter(m => m !== marker);
-                    layer.closePopup();
-                };
-                document.getElementById('select-button').onclick = function () {
-                    handleMarkerSelection(layer);
-                    layer.closePopup();
-                };
-            });
-        }
-        else if (shape.type === "marker") {
-            layer = L.marker(shape.latlngs[0], { draggable: true });
-            drawnItems.addLayer(layer);
-            layer.dragging.enable();
-            attachMarkerLineSync(layer);
+        if (shape.type === "custommarker" || shape.type === "marker") {
+            // created lazily by the cluster index
+            markerShapes.push(shape);
         }
         else if (shape.type === "polyline") {
             layer = L.polyline(shape.latlngs, { color: shape.color || '#3388ff' });
@@ -984,6 +1309,7 @@ function importShapes(jsonStr) {
             drawnItems.addLayer(layer);
         }
     });
+    markerCluster.load(markerShapes);
 }
 
 
@@ -1023,6 +1349,10 @@ function exportShapes(filePath) {
 
         shapes.push(shape);
     });
+    // markers currently folded into clusters
+    markerCluster.hiddenShapes().forEach(s => {
+        shapes.push({ id: s.shapeId || null, type: s.type, latlngs: [{ lat: s.lat, lng: s.lng }] });
+    });
     console.log("Calling Python to save:", filePath, shapes);
     if (window.cefPythonBindings) {
         window.cefPythonBindings.saveShapesToFile(JSON.stringify(shapes), filePath);